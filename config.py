@@ -1,11 +1,15 @@
-import http.server
-import socketserver
+import json
+import selectors
+import socket
+import stat
+import tempfile
 import threading
+import time
 import webbrowser
 import urllib.parse
-import requests
+import urllib.request
 import os
-from dotenv import load_dotenv, set_key
+from dotenv import load_dotenv
 
 # LOAD ENV VARIABLES
 load_dotenv()
@@ -19,6 +23,7 @@ REDIRECT_URI = os.getenv("REDIRECT_URI")
 SCOPE ="invoices.read contacts.read"
 
 auth_code_holder = {"code": None}
+DONE = threading.Event()  # set once the callback server has stopped
 
 def build_authorization_url():
     """
@@ -32,59 +37,98 @@ def build_authorization_url():
     }
     return f"{AUTH_URL}?{urllib.parse.urlencode(params)}"
 
-class OAuthCallbackHandler(http.server.SimpleHTTPRequestHandler):
+CALLBACK_ADDRESS = ("localhost", 3000)
+
+SUCCESS_HTML = b"""
+<html>
+    <body>
+        <h2>Authentication received. This tab will now close.</h2>
+        <script>
+            // Close after 1 second
+            setTimeout(function() { window.close(); }, 800);
+
+            // Fallback if browser blocks window.close()
+            setTimeout(function() {
+                window.location.href = "about:blank";
+            }, 2000);
+        </script>
+    </body>
+</html>
+"""
+NO_CODE_HTML = b"<h2>No authorization code found.</h2>"
+
+def _http_response(status: str, body: bytes = b"") -> bytes:
     """
-    Simple HTTP server to handle OAuth2 callback and capture authorization code.
+    Build a minimal HTTP/1.1 response that closes the connection.
     """
-    def do_GET(self):
-        parsed = urllib.parse.urlparse(self.path)
-
-        if parsed.path == "/callback":
-            qs = urllib.parse.parse_qs(parsed.query)
-            code = qs.get("code", [None])[0]
-
-            if code:
-                auth_code_holder["code"] = code
-
-                self.send_response(200)
-                self.send_header("Content-type", "text/html")
-                self.end_headers()
-
-                html = b"""
-                <html>
-                    <body>
-                        <h2>Authentication received. This tab will now close.</h2>
-                        <script>
-                            // Close after 1 second
-                            setTimeout(function() { window.close(); }, 800);
-
-                            // Fallback if browser blocks window.close()
-                            setTimeout(function() {
-                                window.location.href = "about:blank";
-                            }, 2000);
-                        </script>
-                    </body>
-                </html>
-                """
-
-                self.wfile.write(html)
-
-            else:
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"<h2>No authorization code found.</h2>")
-
-        else:
-            self.send_response(404)
-            self.end_headers()
+    head = (
+        f"HTTP/1.1 {status}\r\nContent-Type: text/html\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    )
+    return head.encode("ascii") + body
+
+# Responses are fixed, so build them (headers included) once at import
+SUCCESS_RESPONSE = _http_response("200 OK", SUCCESS_HTML)
+NO_CODE_RESPONSE = _http_response("200 OK", NO_CODE_HTML)
+NOT_FOUND_RESPONSE = _http_response("404 Not Found")
+
+def handle_callback_request(conn: socket.socket) -> str | None:
+    """
+    Read one HTTP request from the browser, answer it, and return the
+    authorization code if it was a /callback request carrying one.
+    """
+    request = b""
+    while b"\r\n\r\n" not in request:
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        request += chunk
+
+    # e.g. "GET /callback?code=... HTTP/1.1"
+    parts = request.split(b"\r\n", 1)[0].decode("latin-1").split(" ")
+    path = parts[1] if len(parts) == 3 and parts[0] == "GET" else ""
+    parsed = urllib.parse.urlparse(path)
+
+    if parsed.path != "/callback":
+        conn.sendall(NOT_FOUND_RESPONSE)
+        return None
+
+    code = urllib.parse.parse_qs(parsed.query).get("code", [None])[0]
+    conn.sendall(SUCCESS_RESPONSE if code else NO_CODE_RESPONSE)
+    return code
 
 def start_callback_server():
     """
-    Start the HTTP server to listen for OAuth2 callback.
+    Listen for the OAuth2 callback and capture the authorization code.
+    Blocks in select() between connections instead of polling, and
+    sets DONE when it stops.
     """
-    with socketserver.TCPServer(("localhost", 3000), OAuthCallbackHandler) as httpd:
-        while auth_code_holder["code"] is None:
-            httpd.handle_request()
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv, selectors.DefaultSelector() as sel:
+            srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            srv.bind(CALLBACK_ADDRESS)
+            srv.listen()
+            srv.setblocking(False)
+            sel.register(srv, selectors.EVENT_READ)
+
+            while auth_code_holder["code"] is None:
+                sel.select()
+                try:
+                    conn, _ = srv.accept()
+                except BlockingIOError:
+                    continue
+                with conn:
+                    # browsers may open speculative connections that never send a request
+                    conn.settimeout(5)
+                    try:
+                        code = handle_callback_request(conn)
+                    except OSError:
+                        continue
+                if code:
+                    auth_code_holder["code"] = code
+    finally:
+        # wake main() whether we got a code or the server failed
+        DONE.set()
 
 def exchange_code_for_token(code: str) -> dict:
     """
@@ -97,43 +141,99 @@ def exchange_code_for_token(code: str) -> dict:
         "client_id": CLIENT_ID,
         "client_secret": CLIENT_SECRET,
     }
-    resp = requests.post(TOKEN_URL, data=data, timeout=30)
-    resp.raise_for_status()
-    return resp.json()
+    req = urllib.request.Request(TOKEN_URL, data=urllib.parse.urlencode(data).encode(), method="POST")
+    # urlopen raises HTTPError for non-2xx responses
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        return json.load(resp)
 
-def save_tokens_to_env(code: str, access_token: str, refresh_token: str | None):
+def _env_quote(value: str) -> str:
+    """
+    Quote a value the way python-dotenv's set_key does, so it reads back unchanged.
+    """
+    return "'{}'".format(value.replace("'", "\\'"))
+
+def bulk_set_env(updates: dict[str, str], path: str = ENV_PATH):
+    """
+    Set several keys in the .env file with a single read and write,
+    keeping comments and the order of existing entries.
+    """
+    # update a symlinked .env through its target rather than replacing the link
+    path = os.path.realpath(path)
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        # keep the file's permissions across the swap, as set_key does
+        original_mode = stat.S_IMODE(os.lstat(path).st_mode)
+    except FileNotFoundError:
+        lines = []
+        original_mode = None
+
+    pending = dict(updates)
+    for i, line in enumerate(lines):
+        if "=" not in line:
+            continue
+        key = line.split("=", 1)[0].strip()
+        prefix = ""
+        if key.startswith("export "):
+            prefix = "export "
+            key = key[len(prefix):].strip()
+        if key in pending:
+            lines[i] = f"{prefix}{key}={_env_quote(pending.pop(key))}"
+    lines += [f"{key}={_env_quote(value)}" for key, value in pending.items()]
+
+    # write a sibling temp file and swap it in, so an interrupted write
+    # (e.g. from the background refresh thread at exit) never truncates .env
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(os.path.abspath(path)), encoding="utf-8", delete=False
+    ) as f:
+        f.write("\n".join(lines) + "\n")
+    try:
+        if original_mode is not None:
+            os.chmod(f.name, original_mode)
+        os.replace(f.name, path)
+    except OSError:
+        os.remove(f.name)
+        raise
+
+def save_tokens_to_env(code: str, access_token: str, refresh_token: str | None, expires_at: int | None = None):
     """
-    Save authorization code and tokens into .env file.
+    Save authorization code, tokens and access token expiry into .env file.
     """
-    set_key(ENV_PATH, "AUTH_CODE", code)
-    set_key(ENV_PATH, "ACCESS_TOKEN", access_token)
+    updates = {"AUTH_CODE": code, "ACCESS_TOKEN": access_token}
     if refresh_token:
-        set_key(ENV_PATH, "REFRESH_TOKEN", refresh_token)
+        updates["REFRESH_TOKEN"] = refresh_token
+    if expires_at:
+        updates["EXPIRES_AT"] = str(expires_at)
+    bulk_set_env(updates)
     print("[APP] tokens saved to .env")
 
 def main():
     """
     Main function to run the OAuth2 authorization flow.
     """
-    server_thread = threading.Thread(target=start_callback_server, daemon=True)
-    server_thread.start()
+    threading.Thread(target=start_callback_server, daemon=True).start()
     auth_url = build_authorization_url()
     print("[APP] open:", auth_url)
     webbrowser.open(auth_url)
 
-    server_thread.join()
+    DONE.wait()
 
     code = auth_code_holder["code"]
+    if not code:
+        print("[APP] callback server stopped without an authorization code")
+        return
     print(f"[APP] got code: {code}")
 
     token_data = exchange_code_for_token(code)
     access_token = token_data.get("access_token")
     refresh_token = token_data.get("refresh_token")
+    expires_in = token_data.get("expires_in")
+    expires_at = int(time.time()) + int(expires_in) if expires_in else None
 
     print("[APP] access_token :", access_token)
     print("[APP] refresh_token:", refresh_token)
 
-    save_tokens_to_env(code, access_token, refresh_token)
+    save_tokens_to_env(code, access_token, refresh_token, expires_at)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,25 @@
 import os
+import stat
 import csv
+import math
+import sys
+import time
+import tempfile
+import threading
+import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import lru_cache
 from dotenv import load_dotenv
-from dotenv import set_key
+from config import bulk_set_env
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 load_dotenv()
 
@@ -16,20 +32,64 @@ CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
 CSV_FILE = os.getenv("CSV_FILE", "invoices.csv")
-
-def save_tokens(access_token: str, refresh_token: str | None):
+EXPIRES_AT = float(os.getenv("EXPIRES_AT") or 0)
+
+# Refresh this many seconds before the access token expires
+REFRESH_MARGIN = 60
+# Never wait less than this between background refreshes (short-lived tokens)
+MIN_REFRESH_DELAY = 10
+
+# Invoice statuses that are never listed
+_SKIP_STATUSES = frozenset(("deleted", "delete", "archived"))
+
+# Console row templates, bound once so the format spec isn't re-parsed per row
+_ROW_FMT = "{:<15} | {:<10} | {:<15} | {:<8} | {:<20.20} | {:>10.2f} | {:>5} | {:>10.2f}".format
+_ROW_EMPTY_FMT = ("{:<15} | {:<10} | {:<15} | {:<8} | " + f"{'-':<20} | {'-':>10} | {'-':>5} | {'-':>10}").format
+
+# Shared pool for per-invoice API calls (I/O bound, so threads overlap well)
+EXECUTOR = ThreadPoolExecutor(max_workers=16)
+# Separate small pool so page fetches never queue behind detail/contact calls
+PAGE_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Single keep-alive session so every call reuses pooled TCP/TLS connections
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=20,
+        # hand the last response back after retries so callers' resp.ok checks still apply
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        ),
+    ),
+)
+SESSION.headers["Authorization"] = f"Bearer {ACCESS_TOKEN}"
+# requests already sends Accept-Encoding (gzip/deflate, plus br/zstd when installed)
+SESSION.headers["Accept"] = "application/json"
+
+_refresh_lock = threading.Lock()
+_refresh_in_progress: Future | None = None
+
+def save_tokens(access_token: str, refresh_token: str | None, expires_at: float | None = None):
     """
     Save updated tokens into .env for future runs.
     """
-    set_key(".env", "ACCESS_TOKEN", access_token)
+    updates = {"ACCESS_TOKEN": access_token}
     if refresh_token:
-        set_key(".env", "REFRESH_TOKEN", refresh_token)
+        updates["REFRESH_TOKEN"] = refresh_token
+    if expires_at:
+        updates["EXPIRES_AT"] = str(int(expires_at))
+    bulk_set_env(updates)
 
 def refresh_access_token() -> str:
     """
     Refresh access token using the refresh token when it expires.
     """
-    global ACCESS_TOKEN, REFRESH_TOKEN
+    global ACCESS_TOKEN, REFRESH_TOKEN, EXPIRES_AT
     if not REFRESH_TOKEN:
         raise RuntimeError("No refresh token available")
 
@@ -39,35 +99,90 @@ def refresh_access_token() -> str:
         "client_id": CLIENT_ID,
         "client_secret": CLIENT_SECRET,
     }
-    resp = requests.post(TOKEN_URL, data=data, timeout=15)
+    # don't send the stale bearer token to the token endpoint
+    resp = SESSION.post(TOKEN_URL, data=data, headers={"Authorization": None}, timeout=15)
     resp.raise_for_status()
     d = resp.json()
-    ACCESS_TOKEN = d["access_token"]
-    REFRESH_TOKEN = d.get("refresh_token", REFRESH_TOKEN)
-    save_tokens(ACCESS_TOKEN, REFRESH_TOKEN)
+    if not d.get("access_token"):
+        raise RuntimeError("Token response has no access_token")
+    expires_in = d.get("expires_in")
+    with _refresh_lock:
+        ACCESS_TOKEN = d["access_token"]
+        SESSION.headers["Authorization"] = f"Bearer {ACCESS_TOKEN}"
+        REFRESH_TOKEN = d.get("refresh_token", REFRESH_TOKEN)
+        EXPIRES_AT = time.time() + int(expires_in) if expires_in else 0
+    save_tokens(ACCESS_TOKEN, REFRESH_TOKEN, EXPIRES_AT)
     return ACCESS_TOKEN
 
+def _refresh_once(stale_auth: str | None) -> str:
+    """
+    Refresh the access token once for all callers that saw the same stale
+    Authorization header; concurrent callers wait for the in-flight refresh.
+    """
+    global _refresh_in_progress
+    with _refresh_lock:
+        if SESSION.headers.get("Authorization") != stale_auth:
+            # someone else already refreshed since this request was sent
+            return ACCESS_TOKEN
+        fut = _refresh_in_progress
+        owner = fut is None
+        if owner:
+            fut = _refresh_in_progress = Future()
+
+    if not owner:
+        return fut.result()
+
+    try:
+        fut.set_result(refresh_access_token())
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _refresh_lock:
+            _refresh_in_progress = None
+    return fut.result()
+
+def _refresh_loop():
+    """
+    Refresh the access token in the background shortly before it expires,
+    so requests don't have to fail with 401 first.
+    """
+    while EXPIRES_AT:
+        # captured before sleeping, so a 401-triggered refresh in the meantime
+        # makes _refresh_once a no-op instead of rotating the token again
+        stale_auth = SESSION.headers.get("Authorization")
+        remaining = EXPIRES_AT - time.time()
+        # tokens living less than REFRESH_MARGIN would otherwise be refreshed non-stop
+        time.sleep(max(remaining - REFRESH_MARGIN, remaining / 2, MIN_REFRESH_DELAY))
+        try:
+            _refresh_once(stale_auth)
+        except (requests.RequestException, RuntimeError) as e:
+            print(f"[error] background token refresh failed: {e}")
+            return
+
 def api_get(path_or_url: str, params: dict | None = None) -> requests.Response:
     """
     Make an authenticated GET request, refreshing token if needed.
     """
-    global ACCESS_TOKEN
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
-
     if path_or_url.startswith("http://") or path_or_url.startswith("https://"):
         url = path_or_url
     else:
         url = f"{BASE_URL}{path_or_url}"
 
-    resp = requests.get(url, headers=headers, params=params, timeout=15)
+    resp = SESSION.get(url, params=params, timeout=15)
 
     if resp.status_code == 401:
-        refresh_access_token()
-        headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
-        resp = requests.get(url, headers=headers, params=params, timeout=15)
+        _refresh_once(resp.request.headers.get("Authorization"))
+        resp = SESSION.get(url, params=params, timeout=15)
 
     return resp
 
+def _json(resp: requests.Response):
+    """
+    Decode a JSON response body, using orjson when it is installed.
+    """
+    return json_loads(resp.content)
+
 @lru_cache(maxsize=None)
 def get_contact_name(contact_id: str) -> str:
     """
@@ -79,17 +194,53 @@ def get_contact_name(contact_id: str) -> str:
     resp = api_get(f"/contacts/{contact_id}/")
     if not resp.ok:
         return f"id:{contact_id}"
-    data = resp.json()
+    data = _json(resp)
     return data.get("name") or data.get("display_name") or f"id:{contact_id}"
 
-# def get_invoice_detail(invoice_id: str) -> dict:
-#     """
-#     Fetch full invoice details.
-#     """
-#     resp = api_get(f"/invoices/{invoice_id}/")
-#     if not resp.ok:
-#         return {}
-#     return resp.json()
+@lru_cache(maxsize=4096)
+def get_invoice_detail(invoice_id: str) -> dict:
+    """
+    Fetch full invoice details, cached per invoice id.
+    """
+    resp = api_get(f"/invoices/{invoice_id}/")
+    if not resp.ok:
+        return {}
+    return _json(resp)
+
+def _page_params(page: int) -> dict:
+    """
+    Query params for one page of the invoice listing.
+    """
+    # embed line items in the listing to avoid a detail GET per invoice
+    params = {"page": page, "expand": "line_items"}
+    if PAGE_SIZE:
+        params["page_size"] = PAGE_SIZE
+    return params
+
+def _total_pages(resp: requests.Response, data, per_page: int) -> int | None:
+    """
+    Number of listing pages when the API reports a total invoice count,
+    either as an X-Total-Count header or a "count" field in the body.
+    """
+    total = resp.headers.get("X-Total-Count")
+    if total is None and isinstance(data, dict):
+        total = data.get("count")
+    try:
+        total = int(total)
+    except (TypeError, ValueError):
+        return None
+    # use the size the server actually returned; it may cap page_size
+    return math.ceil(total / per_page) if per_page else None
+
+def _is_page_numbered(next_url: str | None) -> bool:
+    """
+    True when the listing paginates by ?page=N: there is no next link, or
+    the next link carries a page param. Offset and cursor links ignore
+    page numbers, so those have to be followed instead.
+    """
+    if not next_url:
+        return True
+    return "page" in urllib.parse.parse_qs(urllib.parse.urlparse(next_url).query)
 
 def list_invoices():
     header_str = (
@@ -100,7 +251,6 @@ def list_invoices():
     print(header_str)
     print("-" * len(header_str))
 
-    csv_rows = []
     total_from_api = 0
     total_kept = 0
 
@@ -109,119 +259,27 @@ def list_invoices():
     prev_next = None
     seen_ids = set()
     MAX_PAGES = 500
-
-    while page <= MAX_PAGES:
-        # ---------- Fetch one page ----------
-        if next_url:
-            resp = api_get(next_url)
-        else:
-            params = {"page": page}
-            if PAGE_SIZE:
-                params["page_size"] = PAGE_SIZE
-            resp = api_get("/invoices/", params=params)
-
-        if resp.status_code == 404:
-            break
-        if not resp.ok:
-            print(f"[error] page {page}: {resp.status_code} {resp.text}")
-            break
-
-        data = resp.json()
-        invoices = data.get("results") or data.get("invoices") or data or []
-        next_url = data.get("next") if isinstance(data, dict) else None
-
-        # stop if no new ids (API repeating same page)
-        new_ids = [inv.get("id") for inv in invoices if inv.get("id") not in seen_ids]
-        if not new_ids:
-            break
-        for _id in new_ids:
-            if _id:
-                seen_ids.add(_id)
-
-        total_from_api += len(invoices)
-        visible_in_page = 0
-
-        # ---------- Process invoices in this page ----------
-        for inv in invoices:
-            inv_id = inv.get("id")
-            if not inv_id:
-                continue
-
-            status_raw = inv.get("status") or ""
-            status_lower = status_raw.lower()
-
-            # skip deleted / archived
-            if status_lower in ("deleted", "delete", "archived"):
-                continue
-
-            inv_no = (
-                inv.get("invoice_number")
-                or inv.get("number")
-                or ""
-            )
-            date = inv.get("invoice_date") or inv.get("date") or ""
-
-            contact_id = inv.get("contact") or inv.get("contact_id")
-            customer = get_contact_name(contact_id) if contact_id else "—"
-
-            status = status_raw or "-"
-            line_items = inv.get("line_items")
-            
-            visible_in_page += 1
-            total_kept += 1
-
-            if not line_items:
-                print(
-                    f"{inv_no:<15} | {date:<10} | {customer:<15} | "
-                    f"{status:<8} | {'-':<20} | {'-':>10} | {'-':>5} | {'-':>10}"
-                )
-                csv_rows.append([inv_no, date, customer, status, "-", "", "", ""])
-                continue
-
-            # Print line items
-            for item in line_items:
-                desc = item.get("description") or item.get("name") or "-"
-                qty = item.get("quantity") or 1
-                line_amount = item.get("line_amount") or 0
-                unit_price = line_amount / qty if qty else line_amount
-
-                print(
-                    f"{inv_no:<15} | {date:<10} | {customer:<15} | "
-                    f"{status:<8} | {desc:<20.20} | "
-                    f"{unit_price:>10.2f} | {qty:>5} | {line_amount:>10.2f}"
-                )
-                csv_rows.append(
-                    [
-                        inv_no,
-                        date,
-                        customer,
-                        status,
-                        desc,
-                        f"{unit_price:.2f}",
-                        qty,
-                        f"{line_amount:.2f}",
-                    ]
-                )
-
-        if visible_in_page:
-            print("-" * len(header_str))
-
-        # ---------- Next page ----------
-        if next_url:
-            if next_url == prev_next:
-                break
-            prev_next = next_url
-        else:
-            page += 1
-
-    # ---------- Summary ----------
-    print(f"Total invoices returned by API (all): {total_from_api}".center(len(header_str)))
-    print(f"Total non-deleted invoices shown: {total_kept}".center(len(header_str)))
-    print("-" * len(header_str))
+    n_pages = None  # known up front when the API reports a total
+    first_page = True
+    pending = deque()  # page requests already in flight, in page order
+    lines = []  # console rows for the current page, written in one go
 
     # ---------- CSV ----------
-    if csv_rows:
-        with open(CSV_FILE, "w", newline="", encoding="utf-8") as f:
+    # rows are streamed to a temp file next to CSV_FILE as they are produced;
+    # it replaces the previous export only if the run completes with rows
+    csv_count = 0
+    tmp = tempfile.NamedTemporaryFile(
+        "w",
+        dir=os.path.dirname(os.path.abspath(CSV_FILE)),
+        prefix=".invoices-",
+        suffix=".csv",
+        newline="",
+        encoding="utf-8",
+        buffering=1 << 20,
+        delete=False,
+    )
+    try:
+        with tmp as f:
             writer = csv.writer(f)
             writer.writerow(
                 [
@@ -235,11 +293,176 @@ def list_invoices():
                     "line_total",
                 ]
             )
-            writer.writerows(csv_rows)
+            # bound once; called for every row below
+            write_row = writer.writerow
+            add_line = lines.append
+            fmt2 = "{:.2f}".format
+            seen_add = seen_ids.add
+            is_seen = seen_ids.__contains__
+
+            try:
+                while page <= MAX_PAGES:
+                    # ---------- Fetch one page ----------
+                    if pending:
+                        resp = pending.popleft().result()
+                    elif next_url:
+                        resp = api_get(next_url)
+                    else:
+                        resp = api_get("/invoices/", params=_page_params(page))
+
+                    if resp.status_code == 404:
+                        break
+                    if not resp.ok:
+                        print(f"[error] page {page}: {resp.status_code} {resp.text}")
+                        break
+
+                    data = _json(resp)
+                    invoices = data.get("results") or data.get("invoices") or data or []
+                    next_url = data.get("next") if isinstance(data, dict) else None
+                    if not next_url:
+                        # RFC 5988 Link: <...>; rel="next"
+                        next_url = resp.links.get("next", {}).get("url")
+
+                    # keep only invoices not seen on earlier pages, in one pass;
+                    # deleted / archived ones are dropped before any contact or detail lookup
+                    any_new = False
+                    kept = []
+                    for inv in invoices:
+                        _id = inv.get("id")
+                        if _id and not is_seen(_id):
+                            seen_add(_id)
+                            any_new = True
+                            if (inv.get("status") or "").lower() not in _SKIP_STATUSES:
+                                kept.append(inv)
+                    # stop if no new ids (API repeating same page)
+                    if not any_new:
+                        break
+
+                    # ---------- Queue upcoming pages while this one is processed ----------
+                    if first_page:
+                        first_page = False
+                        if _is_page_numbered(next_url):
+                            n_pages = _total_pages(resp, data, len(invoices))
+                        if n_pages:
+                            # page count is known: request every remaining page now
+                            next_url = None
+                            pending.extend(
+                                PAGE_EXECUTOR.submit(api_get, "/invoices/", _page_params(p))
+                                for p in range(2, min(n_pages, MAX_PAGES) + 1)
+                            )
+                    if not n_pages:
+                        # otherwise stay one page ahead
+                        if next_url:
+                            if next_url != prev_next:
+                                pending.append(PAGE_EXECUTOR.submit(api_get, next_url))
+                        elif page < MAX_PAGES:
+                            pending.append(PAGE_EXECUTOR.submit(api_get, "/invoices/", _page_params(page + 1)))
+
+                    total_from_api += len(invoices)
+                    visible_in_page = 0
+
+                    # ---------- Resolve unique contacts for this page concurrently ----------
+                    contact_ids = list({inv.get("contact") or inv.get("contact_id") for inv in kept} - {None, ""})
+                    contact_names = dict(zip(contact_ids, EXECUTOR.map(get_contact_name, contact_ids)))
+
+                    # fall back to the detail endpoint only for invoices listed without line items
+                    missing_ids = [inv.get("id") for inv in kept if inv.get("line_items") is None]
+                    details = dict(zip(missing_ids, EXECUTOR.map(get_invoice_detail, missing_ids)))
+
+                    # ---------- Process invoices in this page ----------
+                    for inv in kept:
+                        inv_get = inv.get
+                        inv_id = inv_get("id")
+
+                        status_raw = inv_get("status") or ""
+
+                        inv_no = (
+                            inv_get("invoice_number")
+                            or inv_get("number")
+                            or ""
+                        )
+                        date = inv_get("invoice_date") or inv_get("date") or ""
+
+                        contact_id = inv_get("contact") or inv_get("contact_id")
+                        customer = contact_names.get(contact_id, "—")
+
+                        status = status_raw or "-"
+                        line_items = inv_get("line_items")
+                        if line_items is None:
+                            line_items = details.get(inv_id, {}).get("line_items")
+
+                        visible_in_page += 1
+                        total_kept += 1
+
+                        if not line_items:
+                            add_line(_ROW_EMPTY_FMT(inv_no, date, customer, status))
+                            write_row((inv_no, date, customer, status, "-", "", "", ""))
+                            csv_count += 1
+                            continue
+
+                        # Print line items
+                        for item in line_items:
+                            item_get = item.get
+                            desc = item_get("description") or item_get("name") or "-"
+                            qty = item_get("quantity") or 1
+                            line_amount = item_get("line_amount") or 0
+                            unit_price = line_amount / qty if qty else line_amount
+
+                            add_line(_ROW_FMT(inv_no, date, customer, status, desc, unit_price, qty, line_amount))
+                            write_row((inv_no, date, customer, status, desc, fmt2(unit_price), qty, fmt2(line_amount)))
+                            csv_count += 1
+
+                    if visible_in_page:
+                        lines.append("-" * len(header_str))
+                        sys.stdout.write("\n".join(lines) + "\n")
+                        lines.clear()
+
+                    # ---------- Next page ----------
+                    if n_pages:
+                        if not pending:
+                            break
+                        page += 1
+                    elif next_url:
+                        if next_url == prev_next:
+                            break
+                        prev_next = next_url
+                    else:
+                        page += 1
+            finally:
+                # don't leave queued page requests running after an early exit
+                for fut in pending:
+                    fut.cancel()
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+
+    if csv_count:
+        # NamedTemporaryFile is created 0600; give the export the permissions
+        # a plain open() would have (or keep the existing file's mode)
+        try:
+            mode = stat.S_IMODE(os.stat(CSV_FILE).st_mode)
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp.name, mode)
+        os.replace(tmp.name, CSV_FILE)
+    else:
+        os.remove(tmp.name)
+
+    # ---------- Summary ----------
+    print(f"Total invoices returned by API (all): {total_from_api}".center(len(header_str)))
+    print(f"Total non-deleted invoices shown: {total_kept}".center(len(header_str)))
+    print("-" * len(header_str))
+
+    if csv_count:
         print(f"[CSV] saved to {CSV_FILE}")
+    else:
+        print("[CSV] no rows to write")
 
 if __name__ == "__main__":
     if not ACCESS_TOKEN:
         print("[error] ACCESS_TOKEN not set. Run config.py first.")
     else:
+        threading.Thread(target=_refresh_loop, daemon=True).start()
         list_invoices()